@@ -1,12 +1,27 @@
 import streamlit as st
 import os
-import google.generativeai as genai
+import tempfile
 from dotenv import load_dotenv
-import PyPDF2
-from io import BytesIO
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseDownload
+from core import (
+    AD_COPY_SEPARATOR,
+    BATCH_THRESHOLD,
+    FALLBACK_MODEL_NAME,
+    MODEL_NAME,
+    PRESCREEN_MAX_CHARS,
+    SEMANTIC_CACHE_THRESHOLD,
+    SERVICE_TIERS,
+    analyze_compliance,
+    dedupe_paragraphs,
+    extract_text_from_uploaded_file,
+    extract_text_once,
+    fetch_batch_results,
+    read_pdf_file,
+    split_ad_copies,
+    submit_batch_analysis,
+)
 
 # =========================================================
 # Config
@@ -50,80 +65,23 @@ def load_pdf_from_drive_api(file_id):
         # 2. 建立 Drive API 服務
         service = build('drive', 'v3', credentials=creds)
 
-        # 3. 下載檔案
+        # 3. 下載檔案 (直接寫入暫存檔，不在記憶體中累積整份 PDF)
         request = service.files().get_media(fileId=file_id)
-        file_stream = BytesIO()
-        downloader = MediaIoBaseDownload(file_stream, request)
-        
-        done = False
-        while done is False:
-            status, done = downloader.next_chunk()
-
-        # 4. 解析 PDF
-        file_stream.seek(0) # 回到檔案開頭
-        reader = PyPDF2.PdfReader(file_stream)
-        text = ""
-        for page in reader.pages:
-            text += page.extract_text() + "\n"
-            
-        return text, None
-
-    except Exception as e:
-        return None, f"讀取雲端 PDF 失敗: {str(e)}"
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            pdf_path = os.path.join(tmp_dir, "violation_db.pdf")
+            with open(pdf_path, "wb") as file_stream:
+                downloader = MediaIoBaseDownload(file_stream, request)
 
-def extract_text_from_uploaded_file(uploaded_file):
-    """(保留) 從使用者手動上傳的檔案中提取文字"""
-    if uploaded_file is None: return ""
-    try:
-        if uploaded_file.type == "application/pdf":
-            reader = PyPDF2.PdfReader(uploaded_file)
-            text = ""
-            for page in reader.pages:
-                text += page.extract_text() + "\n"
-            return text
-        elif uploaded_file.type == "text/plain":
-            return uploaded_file.getvalue().decode("utf-8")
-        return ""
-    except Exception as e:
-        return ""
+                done = False
+                while done is False:
+                    status, done = downloader.next_chunk()
 
-def analyze_compliance(api_key, ad_copy, reference_data):
-    """Gemini 分析邏輯"""
-    if not api_key: return "請輸入 API Key"
+            # 4. 解析 PDF (內容未變時直接命中解析快取)
+            text = dedupe_paragraphs(read_pdf_file(pdf_path))
+        return text, None
 
-    genai.configure(api_key=api_key)
-    # 優先使用最新的推理模型
-    model_name = "gemini-3-pro-preview" 
-    
-    system_instruction = """
-    你是一位精通台灣法規的「首席合規長」。你的任務是依據【違規資料庫】與【台灣法規】審查文案。
-    比對原則：
-    1. 若文案出現與【違規資料庫】相似的詞彙或邏輯，視為極高風險。
-    2. 嚴格審查「療效」、「誇大」、「保證」等概念。
-    """
-    
-    try:
-        model = genai.GenerativeModel(model_name, system_instruction=system_instruction)
-        prompt = f"""
-        請分析以下文案的合規性：
-
-        ### 1. 核心判例標準（來自雲端資料庫）：
-        {reference_data}
-
-        ### 2. 待審文案：
-        {ad_copy}
-
-        ---
-        請輸出 Markdown 報告：
-        1. **風險評級**
-        2. **違規熱點與解釋** (請明確指出違反資料庫中哪一條)
-        3. **修改建議**
-        """
-        
-        response = model.generate_content(prompt)
-        return response.text
     except Exception as e:
-        return f"AI 分析錯誤: {e}"
+        return None, f"讀取雲端 PDF 失敗: {str(e)}"
 
 # =========================================================
 # Sidebar
@@ -137,13 +95,54 @@ with st.sidebar:
         env_api_key = st.secrets["GOOGLE_API_KEY"]
 
     api_key = st.text_input("Google Gemini API Key", value=env_api_key if env_api_key else "", type="password")
+
+    tier_label = st.radio(
+        "推論層級",
+        list(SERVICE_TIERS),
+        index=1,
+        horizontal=True,
+        help="快速：優先處理、延遲最低；標準：一般計價；經濟：費用減半，適合不急的報告"
+    )
+
+    prescreen_mode = st.toggle(
+        "關鍵字快篩",
+        value=False,
+        help=f"短於 {PRESCREEN_MAX_CHARS} 字且未出現敏感詞的文案直接判定為低風險，不呼叫 Gemini"
+    )
+
+    semantic_cache_mode = st.toggle(
+        "相似文案快取",
+        value=False,
+        help=f"與先前文案的向量相似度達 {SEMANTIC_CACHE_THRESHOLD} 且敏感詞相同時沿用舊報告；"
+             "敏感詞清單之外的宣稱差異 (例如「改善便秘」與「幫助消化」) 可能被忽略"
+    )
+
+    hedged_mode = st.toggle(
+        "可靠模式",
+        help=f"同時呼叫 {MODEL_NAME} 與 {FALLBACK_MODEL_NAME}，採用先完成的結果；延遲較穩定，但費用最多加倍"
+    )
+
+    multi_copy_mode = st.toggle(
+        "多篇文案模式",
+        help=f"貼上的文字以單獨一行的 {AD_COPY_SEPARATOR} 分隔為多篇文案；超過 {BATCH_THRESHOLD} 篇時自動改用批次模式"
+    )
+
+    batch_mode = st.toggle(
+        "批次模式 (Batch API)",
+        help="非同步處理、費用減半，適合一次審核多篇文案 (貼上的文字同樣以分隔線拆成多篇)"
+    )
     
     st.markdown("---")
     st.subheader("📡 資料庫狀態")
     
-    # 自動讀取雲端 PDF
-    with st.spinner("正在連線 Google Drive 讀取法規資料庫..."):
-        cloud_db_text, error_msg = load_pdf_from_drive_api(DRIVE_FILE_ID)
+    # 自動讀取雲端 PDF (每個 session 只讀取一次，之後的 rerun 直接取用 session_state)
+    if st.button("🔄 重新載入資料庫", use_container_width=True):
+        load_pdf_from_drive_api.clear()
+        st.session_state.pop("cloud_db", None)
+    if "cloud_db" not in st.session_state:
+        with st.spinner("正在連線 Google Drive 讀取法規資料庫..."):
+            st.session_state.cloud_db = load_pdf_from_drive_api(DRIVE_FILE_ID)
+    cloud_db_text, error_msg = st.session_state.cloud_db
     
     if cloud_db_text:
         st.success(f"✅ 雲端資料庫已連線\n(字數: {len(cloud_db_text)})")
@@ -169,32 +168,72 @@ with col1:
         st.warning("雲端讀取失敗，請手動上傳備用檔案：")
         uploaded_db = st.file_uploader("手動上傳資料庫 (PDF)", type=["pdf"])
         if uploaded_db:
-            cloud_db_text = extract_text_from_uploaded_file(uploaded_db)
+            cloud_db_text = extract_text_once(
+                uploaded_db, "uploaded_db", lambda f: dedupe_paragraphs(extract_text_from_uploaded_file(f))
+            )
 
 with col2:
     st.subheader("2. 輸入文案")
     tab_text, tab_file = st.tabs(["貼上文字", "上傳檔案"])
     
     ad_text = ""
+    ad_from_file = False
     with tab_text:
-        raw_text = st.text_area("直接貼上文案", height=200)
+        raw_text = st.text_area(
+            "直接貼上文案", height=200,
+            help=f"開啟「多篇文案模式」或「批次模式」時，以單獨一行的 {AD_COPY_SEPARATOR} 分隔多篇文案"
+        )
         if raw_text: ad_text = raw_text
         
     with tab_file:
         up_file = st.file_uploader("上傳文案檔案", type=["pdf", "txt"])
-        if up_file: ad_text = extract_text_from_uploaded_file(up_file)
+        if up_file:
+            ad_text = extract_text_once(up_file, "up_file")
+            ad_from_file = True
 
 st.markdown("---")
 
 if st.button("🚀 執行合規分析", type="primary", use_container_width=True):
+    # 只有使用者明確開啟多篇 / 批次模式時才拆分貼上的文字；上傳檔案一律視為單篇
+    if (multi_copy_mode or batch_mode) and not ad_from_file:
+        ad_copies = split_ad_copies(ad_text)
+    else:
+        ad_copies = [ad_text.strip()] if ad_text.strip() else []
     if not api_key:
         st.warning("缺少 API Key")
-    elif not ad_text:
+    elif not ad_copies:
         st.warning("請輸入文案內容")
     elif not cloud_db_text:
         st.warning("資料庫未載入，無法分析")
+    elif batch_mode or len(ad_copies) > BATCH_THRESHOLD:
+        try:
+            with st.spinner(f"正在建立 {len(ad_copies)} 篇文案的批次工作..."):
+                st.session_state.batch_job = submit_batch_analysis(api_key, ad_copies, cloud_db_text)
+            st.success(f"✅ 已送出批次工作：{st.session_state.batch_job}\n完成後請按下方「查詢批次結果」。")
+        except Exception as e:
+            st.error(f"建立批次工作失敗: {e}")
     else:
         with st.spinner("Gemini 3 Pro 正在交叉比對雲端資料庫..."):
-            result = analyze_compliance(api_key, ad_text, cloud_db_text)
-            st.markdown("### 分析報告")
-            st.markdown(result)
+            for i, ad_copy in enumerate(ad_copies, start=1):
+                st.markdown("### 分析報告" if len(ad_copies) == 1 else f"### 分析報告 #{i}")
+                placeholder = st.empty()
+                result = analyze_compliance(
+                    api_key, ad_copy, cloud_db_text, SERVICE_TIERS[tier_label], placeholder,
+                    hedged=hedged_mode, prescreen=prescreen_mode, semantic_cache=semantic_cache_mode
+                )
+                if result:
+                    placeholder.markdown(result)
+
+if "batch_job" in st.session_state:
+    if st.button(f"🔄 查詢批次結果 ({st.session_state.batch_job})", use_container_width=True):
+        try:
+            state, reports = fetch_batch_results(api_key, st.session_state.batch_job)
+        except Exception as e:
+            st.error(f"查詢批次工作失敗: {e}")
+        else:
+            if reports is None:
+                st.info(f"批次工作狀態：{state}")
+            else:
+                for i, report in enumerate(reports, start=1):
+                    st.markdown(f"### 分析報告 #{i}")
+                    st.markdown(report)
@@ -0,0 +1,699 @@
+"""
+文案合規檢測的共用核心：PDF 解析、Prompt 組合與 Gemini 分析。
+雲端連線版 (app.py) 與下載版 (compliance_report) 共用此模組，快取也因此共用。
+"""
+import os
+import re
+import asyncio
+import mmap
+import json
+import hashlib
+import time
+import tempfile
+import threading
+import streamlit as st
+from google import genai
+from google.genai import errors, types
+import numpy as np
+import pypdfium2 as pdfium
+
+# =========================================================
+# Config
+# =========================================================
+# 優先使用最新的推理模型
+MODEL_NAME = "gemini-3-pro-preview"
+
+# 可靠模式下與主模型同時呼叫的備援模型
+FALLBACK_MODEL_NAME = "gemini-2.5-pro"
+
+# 待審文案超過此篇數時自動改走 Batch API (非同步、費用減半)
+BATCH_THRESHOLD = 5
+
+# 串流報告的最短重繪間隔 (秒)
+STREAM_RENDER_INTERVAL = 0.1
+
+# 資料庫 Context Cache 的存活時間 (秒)
+CONTEXT_CACHE_TTL = 3600
+
+# 推論服務層級：快速 (priority，低延遲) / 標準 (standard) / 經濟 (flex，費用減半、可能排隊)
+SERVICE_TIERS = {"快速": "priority", "標準": "standard", "經濟": "flex"}
+
+# 額度不足時的降級順序
+SERVICE_TIER_LADDER = ["priority", "standard", "flex"]
+
+# 分析報告快取：完全相同的輸入直接重用；開啟相似文案快取時，文案向量相似度超過門檻也視為命中
+REPORT_CACHE_DIR = os.path.join(".cache", "reports")
+EMBEDDING_MODEL = "gemini-embedding-001"
+SEMANTIC_CACHE_THRESHOLD = 0.92
+# 每個資料庫 (及 API Key) 最多保留的報告數，超過時淘汰最舊的報告
+REPORT_CACHE_MAX_ENTRIES = 200
+
+# 資料庫檢索：依行切成約 CHUNK_SIZE 字的區塊，只取與文案最相關的 RETRIEVAL_TOP_K 塊；
+# 資料庫短於 RETRIEVAL_MIN_CHARS 時整份送出並使用 Context Cache (快取折扣比檢索更划算)
+CHUNK_SIZE = 1000
+RETRIEVAL_TOP_K = 8
+RETRIEVAL_MIN_CHARS = CHUNK_SIZE * RETRIEVAL_TOP_K * 10
+INDEX_CACHE_DIR = os.path.join(".cache", "index")
+
+# 單次請求允許的輸入 token 上限 (模型上下文 1,048,576，保留輸出與提示詞空間)
+MAX_INPUT_TOKENS = 1_000_000
+# 每個字元的 token 數上限估計：罕用漢字與 emoji 走位元組後備編碼時可達 3–4 個 token
+MAX_TOKENS_PER_CHAR = 4
+
+# 本地快篩用的敏感詞；短於 PRESCREEN_MAX_CHARS 且未命中任何詞的文案不送 Gemini
+SENSITIVE_TERMS = [
+    "療效", "治療", "根治", "醫療", "保證", "第一", "唯一", "最佳", "100%",
+    "快速瘦身", "減肥", "再生", "回春", "抗炎", "消炎", "抗老", "美白", "無副作用",
+]
+SENSITIVE_TERMS_PATTERN = re.compile("|".join(re.escape(term) for term in SENSITIVE_TERMS))
+PRESCREEN_MAX_CHARS = 300
+
+# 批次模式下，多篇文案以單獨一行的分隔線隔開
+AD_COPY_SEPARATOR = "---"
+
+SYSTEM_INSTRUCTION = """
+你是一位精通台灣法規的「首席合規長 (Chief Compliance Officer)」。
+你的專長領域包含：
+1. 《公平交易法》（不實廣告、誇大不實）
+2. 《消費者保護法》
+3. 特殊產業法規：如《藥事法》、《醫療器材管理法》、《化粧品衛生安全管理法》、《食品安全衛生管理法》。
+
+你的任務是依據【違規資料庫 / 參考資料】與【台灣法規】審查使用者的行銷文案，並進行風險評估。
+比對原則：
+1. 若文案出現與【違規資料庫】相似的詞彙或邏輯，視為極高風險。
+2. 對於「療效」、「誇大」、「保證」、「第一」、「唯一」等敏感概念保持高度警戒。
+"""
+
+# 降低隨機性，提高分析精準度
+GENERATION_PARAMS = {"temperature": 0.2, "top_p": 0.8, "top_k": 40}
+
+# =========================================================
+# Helper Functions: PDF
+# =========================================================
+_PDFIUM_LOCK = threading.Lock()
+
+def iter_pdf_pages(data):
+    """逐頁產生 PDF 文字 (data 可為 bytes 或檔案路徑)，不需先把整份文件組成一個大字串"""
+    # PDFium 非執行緒安全 (即使是不同文件也不可同時呼叫)；
+    # 各 Streamlit session 跑在各自的執行緒上，因此每次呼叫 PDFium 都需持有全域鎖
+    with _PDFIUM_LOCK:
+        pdf = pdfium.PdfDocument(data)
+        page_count = len(pdf)
+    try:
+        for index in range(page_count):
+            with _PDFIUM_LOCK:
+                page = pdf[index]
+                textpage = page.get_textpage()
+                text = textpage.get_text_range().replace("\r\n", "\n") # PDFium 以 \r\n 換行
+                textpage.close()
+                page.close()
+            yield text
+    finally:
+        with _PDFIUM_LOCK:
+            pdf.close()
+
+@st.cache_data(show_spinner=False, max_entries=16) # 以內容摘要為快取鍵，相同 PDF 只解析一次；限制筆數避免解析結果常駐記憶體
+def _read_pdf_buffer(digest, _data):
+    """
+    從 PDF (bytes 或檔案路徑) 中提取文字 (_data 不參與 Streamlit 雜湊，快取鍵即 digest)；
+    PDFium 不會輸出空行，因此頁與頁之間以空行分隔，後續去重與切塊才能以頁為單位
+    """
+    return "\n\n".join(iter_pdf_pages(_data))
+
+def read_pdf_bytes(data):
+    """以 BLAKE2b 摘要作為快取鍵解析 PDF bytes"""
+    return _read_pdf_buffer(hashlib.blake2b(data, digest_size=16).hexdigest(), data)
+
+def read_pdf_file(path):
+    """
+    以 mmap 計算檔案摘要 (由 OS page cache 提供內容，不複製進 Python 記憶體)；
+    快取未命中時交由 PDFium 直接讀取檔案路徑解析
+    """
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        digest = hashlib.blake2b(mm, digest_size=16).hexdigest()
+    return _read_pdf_buffer(digest, path)
+
+def dedupe_paragraphs(text):
+    """
+    移除重複的段落 (以空行分段：PDF 為每一頁，TXT 為原本的段落；依 BLAKE2b 摘要比對)，
+    保留第一次出現的位置
+    """
+    seen = set()
+    paragraphs = []
+    for paragraph in re.split(r"\n\s*\n+", text.replace("\r\n", "\n")):
+        key = hashlib.blake2b(paragraph.strip().encode("utf-8"), digest_size=8).digest()
+        if paragraph.strip() and key not in seen:
+            seen.add(key)
+            paragraphs.append(paragraph)
+    return "\n\n".join(paragraphs)
+
+# =========================================================
+# Helper Functions: Uploads
+# =========================================================
+def extract_text_from_uploaded_file(uploaded_file):
+    """從上傳的檔案 (TXT, PDF) 中提取文字"""
+    if uploaded_file is None: return ""
+    try:
+        data = uploaded_file.getvalue() # 只取一次 bytes，解析與快取鍵共用
+        if uploaded_file.type == "application/pdf":
+            return read_pdf_bytes(data)
+        elif uploaded_file.type == "text/plain":
+            return data.decode("utf-8")
+        st.error("目前僅支援 PDF 與 TXT 格式")
+        return ""
+    except Exception as e:
+        st.error(f"檔案讀取失敗: {e}")
+        return ""
+
+def extract_text_once(uploaded_file, key, parse=extract_text_from_uploaded_file):
+    """同一個上傳檔案 (以 file_id 判斷) 只解析一次，之後的 rerun 直接取用 session_state"""
+    cached = st.session_state.get(key)
+    if cached is None or cached[0] != uploaded_file.file_id:
+        st.session_state[key] = (uploaded_file.file_id, parse(uploaded_file))
+    return st.session_state[key][1]
+
+# =========================================================
+# Helper Functions: Prompt
+# =========================================================
+def prescreen_ad_copy(ad_copy):
+    """
+    本地關鍵字快篩：短文案且未出現任何敏感詞時直接回傳低風險報告 (不呼叫 Gemini)；
+    否則回傳 None，交由完整分析
+    """
+    if len(ad_copy) >= PRESCREEN_MAX_CHARS or SENSITIVE_TERMS_PATTERN.search(ad_copy):
+        return None
+    return f"""
+1. **風險評級**：低風險 (本地關鍵字快篩)
+2. **違規熱點與解釋**：未偵測到敏感詞彙 ({"、".join(SENSITIVE_TERMS)})。
+3. **修改建議**：無。若文案涉及特定產品功效或需比對資料庫判例，請關閉「關鍵字快篩」後重新分析。
+"""
+
+def build_reference_block(reference_data):
+    """Prompt 中的資料庫段落 (固定前綴，可放入 Context Cache)"""
+    return f"""
+    請分析以下文案的合規性：
+
+    ### 1. 核心判例標準（違規資料庫 / 參考資料）：
+    {reference_data if reference_data else "無提供參考資料，請完全依據台灣法規判斷。"}
+    """
+
+def build_ad_block(ad_copy):
+    """Prompt 中的待審文案與輸出要求 (每次請求不同的部分)"""
+    return f"""
+    ### 2. 待審文案：
+    {ad_copy}
+
+    ---
+    請輸出 Markdown 報告：
+    1. **風險評級**：(低 / 中 / 高 / 極高)
+    2. **違規熱點與解釋**：逐條列出可能違規的句子，並明確指出違反資料庫中哪一條或哪一條法規
+    3. **修改建議**：針對每一個違規點，提供具體的修改建議或「安全替代詞彙」
+    4. **行銷邏輯檢視**：修改後是否保留行銷力度？若沒有，請提供更有說服力且合規的寫法
+    """
+
+def build_prompt(ad_copy, reference_data):
+    """組合單篇文案的完整分析 Prompt"""
+    return build_reference_block(reference_data) + build_ad_block(ad_copy)
+
+def split_ad_copies(text):
+    """依分隔線把輸入拆成多篇文案"""
+    copies = []
+    current = []
+    for line in text.splitlines():
+        if line.strip() == AD_COPY_SEPARATOR:
+            copies.append("\n".join(current))
+            current = []
+        else:
+            current.append(line)
+    copies.append("\n".join(current))
+    return [c.strip() for c in copies if c.strip()]
+
+# =========================================================
+# Helper Functions: Gemini
+# =========================================================
+@st.cache_resource(show_spinner=False) # 同一把 API Key 跨 rerun、跨 session 共用同一個 Client 與其連線池
+def get_client(api_key):
+    """取得 Gemini Client"""
+    return genai.Client(api_key=api_key)
+
+# =========================================================
+# Helper Functions: Report Cache
+# =========================================================
+_REPORT_CACHE_LOCK = threading.Lock()
+
+def _sha256(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def _embed_ad_copy(client, ad_copy):
+    """取得文案的正規化向量；失敗時回傳 None (僅停用語意快取，不影響分析)"""
+    try:
+        result = client.models.embed_content(model=EMBEDDING_MODEL, contents=ad_copy)
+        vector = np.asarray(result.embeddings[0].values, dtype=np.float32)
+        return vector / np.linalg.norm(vector)
+    except Exception:
+        return None
+
+def _atomic_write(path, write):
+    """
+    先寫入同目錄的暫存檔再 os.replace 到目標路徑，
+    其他執行緒或行程只會看到完整的舊檔或新檔，不會讀到寫到一半的內容
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def load_cached_report(report_key):
+    """以 SHA-256 精確比對 (API Key, 模型, 系統提示詞, 資料庫, 文案)；未命中或讀取失敗時回傳 None"""
+    try:
+        with open(os.path.join(REPORT_CACHE_DIR, f"{report_key}.md"), encoding="utf-8") as f:
+            return f.read()
+    except Exception:
+        return None
+
+def _load_report_index(index_path):
+    """讀取相似度索引，回傳 (keys, copies, vectors)；不存在或檔案損毀時回傳 None"""
+    try:
+        with np.load(index_path) as index:
+            return index["keys"], index["copies"], index["vectors"]
+    except Exception:
+        return None
+
+def find_similar_report(context_hash, embedding, ad_copy):
+    """
+    在同一資料庫的歷史文案中找餘弦相似度超過門檻者，回傳 (報告, 原文案)；
+    兩篇文案命中的敏感詞必須完全相同 (多一個「保證根治」就可能改變結論)，
+    未命中或索引無法讀取時回傳 None
+    """
+    if embedding is None:
+        return None
+    with _REPORT_CACHE_LOCK:
+        index = _load_report_index(os.path.join(REPORT_CACHE_DIR, f"{context_hash}.npz"))
+    if index is None:
+        return None
+    keys, copies, vectors = index
+    scores = vectors @ embedding
+    best = int(np.argmax(scores))
+    if scores[best] < SEMANTIC_CACHE_THRESHOLD:
+        return None
+    original_copy = str(copies[best])
+    if set(SENSITIVE_TERMS_PATTERN.findall(original_copy)) != set(SENSITIVE_TERMS_PATTERN.findall(ad_copy)):
+        return None
+    report = load_cached_report(keys[best])
+    return None if report is None else (report, original_copy)
+
+def store_cached_report(context_hash, report_key, embedding, ad_copy, report):
+    """
+    寫入報告，並把文案向量加入該資料庫的相似度索引；索引超過 REPORT_CACHE_MAX_ENTRIES 筆時
+    淘汰最舊的報告。快取只是加速用途，寫入失敗時略過，不影響已產生的報告
+    """
+    # 每份報告都必須登記在索引中才能被淘汰，取不到向量時不寫入
+    if embedding is None:
+        return
+    try:
+        _atomic_write(os.path.join(REPORT_CACHE_DIR, f"{report_key}.md"), lambda f: f.write(report.encode("utf-8")))
+
+        index_path = os.path.join(REPORT_CACHE_DIR, f"{context_hash}.npz")
+        with _REPORT_CACHE_LOCK:
+            index = _load_report_index(index_path)
+            if index is not None:
+                keep = index[0] != report_key
+                keys = np.append(index[0][keep], report_key)
+                copies = np.append(index[1][keep], ad_copy)
+                vectors = np.vstack([index[2][keep], embedding])
+            else:
+                # 索引不存在、已損毀或為舊格式時重新建立
+                keys = np.array([report_key])
+                copies = np.array([ad_copy])
+                vectors = embedding[np.newaxis, :]
+            evicted = keys[:-REPORT_CACHE_MAX_ENTRIES]
+            keys = keys[-REPORT_CACHE_MAX_ENTRIES:]
+            copies = copies[-REPORT_CACHE_MAX_ENTRIES:]
+            vectors = vectors[-REPORT_CACHE_MAX_ENTRIES:]
+            _atomic_write(index_path, lambda f: np.savez(f, keys=keys, copies=copies, vectors=vectors))
+            for key in evicted:
+                try:
+                    os.remove(os.path.join(REPORT_CACHE_DIR, f"{key}.md"))
+                except OSError:
+                    pass
+    except Exception:
+        pass
+
+# =========================================================
+# Helper Functions: Reference Retrieval
+# =========================================================
+def chunk_reference(reference_data):
+    """以行為單位把整行合併為不超過 CHUNK_SIZE 字的區塊，遇到空行（頁面分界）且區塊已過半時優先斷開
+
+    PDF 抽出的文字每行以換行分隔且頁內沒有空行，因此不能依段落切分；
+    只有單行本身超過 CHUNK_SIZE 時才會被硬切。
+    """
+    chunks = []
+    current = ""
+    for line in reference_data.replace("\r\n", "\n").split("\n"):
+        line = line.strip()
+        if not line:
+            if len(current) >= CHUNK_SIZE // 2:
+                chunks.append(current)
+                current = ""
+            continue
+        if current and len(current) + len(line) + 1 > CHUNK_SIZE:
+            chunks.append(current)
+            current = ""
+        while len(line) > CHUNK_SIZE:
+            chunks.append(line[:CHUNK_SIZE])
+            line = line[CHUNK_SIZE:]
+        current = f"{current}\n{line}" if current else line
+    if current:
+        chunks.append(current)
+    return chunks
+
+@st.cache_resource(show_spinner=False) # 同一份資料庫只需向量化一次
+def get_reference_index(api_key, reference_hash, _reference_data):
+    """
+    切分資料庫並取得每個區塊的正規化向量，回傳 (區塊列表, 向量矩陣)；
+    結果寫入磁碟，重新啟動後只要資料庫內容未變即可直接載入，不需重新向量化
+    """
+    index_key = _sha256(EMBEDDING_MODEL, "lines", str(CHUNK_SIZE), reference_hash)
+    index_path = os.path.join(INDEX_CACHE_DIR, f"{index_key}.npz")
+    if os.path.exists(index_path):
+        try:
+            with np.load(index_path) as index:
+                return index["chunks"].tolist(), index["vectors"]
+        except Exception:
+            # 檔案損毀 (例如寫入中途被中斷)：刪除後重新向量化
+            try:
+                os.remove(index_path)
+            except OSError:
+                pass
+
+    client = get_client(api_key)
+    chunks = chunk_reference(_reference_data)
+    vectors = []
+    for start in range(0, len(chunks), 100): # 單次請求最多 100 筆
+        result = client.models.embed_content(model=EMBEDDING_MODEL, contents=chunks[start:start + 100])
+        vectors.extend(e.values for e in result.embeddings)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    # 先寫入暫存檔再置換，讀取端不會看到寫到一半的索引；寫入失敗只是少了磁碟快取
+    try:
+        os.makedirs(INDEX_CACHE_DIR, exist_ok=True)
+        _atomic_write(index_path, lambda f: np.savez(f, chunks=np.array(chunks), vectors=vectors))
+    except OSError:
+        pass
+    return chunks, vectors
+
+def select_relevant_chunks(chunks, vectors, embedding):
+    """取出與文案最相似的 RETRIEVAL_TOP_K 個區塊，並依原文順序串接"""
+    if len(chunks) <= RETRIEVAL_TOP_K:
+        return "\n\n".join(chunks)
+    top = np.argpartition(vectors @ embedding, -RETRIEVAL_TOP_K)[-RETRIEVAL_TOP_K:]
+    return "\n\n".join(chunks[i] for i in sorted(top))
+
+# =========================================================
+# Helper Functions: Analysis
+# =========================================================
+@st.cache_resource(ttl=CONTEXT_CACHE_TTL - 300, show_spinner=False) # 比伺服器端 TTL 早過期，避免拿到已失效的快取
+def get_reference_cache(api_key, reference_hash, _reference_data):
+    """
+    為系統提示詞 + 資料庫建立 Gemini Context Cache，跨 session 共用並回傳快取名稱；
+    資料庫太短 (低於模型最低快取 token 數) 或模型不支援時回傳 None
+    """
+    client = get_client(api_key)
+    try:
+        cache = client.caches.create(
+            model=MODEL_NAME,
+            config=types.CreateCachedContentConfig(
+                display_name=f"compliance-db-{reference_hash[:16]}",
+                system_instruction=SYSTEM_INSTRUCTION,
+                contents=[build_reference_block(_reference_data)],
+                ttl=f"{CONTEXT_CACHE_TTL}s",
+            ),
+        )
+        return cache.name
+    except Exception:
+        return None
+
+@st.cache_data(show_spinner=False) # 每個資料庫版本只計算一次
+def count_reference_tokens(api_key, reference_hash, _reference_data):
+    """以 Gemini count_tokens 取得資料庫的 token 數"""
+    return get_client(api_key).models.count_tokens(model=MODEL_NAME, contents=_reference_data).total_tokens
+
+def fit_reference_to_budget(api_key, reference_hash, reference_data, ad_copy):
+    """
+    資料庫 + 文案超過 MAX_INPUT_TOKENS 時依比例截斷資料庫，
+    避免整份 Prompt 上傳後才被模型以超出上下文長度拒絕
+    """
+    # 以每字 MAX_TOKENS_PER_CHAR 個 token 估計上限，字數夠少時不必計算
+    if (len(reference_data) + len(ad_copy)) * MAX_TOKENS_PER_CHAR <= MAX_INPUT_TOKENS:
+        return reference_data
+    try:
+        reference_tokens = count_reference_tokens(api_key, reference_hash, reference_data)
+    except Exception:
+        reference_tokens = len(reference_data) * MAX_TOKENS_PER_CHAR
+    budget = MAX_INPUT_TOKENS - len(ad_copy) * MAX_TOKENS_PER_CHAR
+    if reference_tokens <= budget:
+        return reference_data
+    st.warning(f"資料庫約 {reference_tokens:,} tokens，超過模型輸入上限，僅送出前段內容")
+    return reference_data[:max(0, len(reference_data) * budget // reference_tokens)]
+
+async def _hedged_generate(api_key, requests):
+    """
+    同時送出多個 (模型, contents, config) 請求，回傳最先產生非空白報告者並取消其餘請求；
+    空白回覆 (被安全機制擋下或只有思考內容) 視為失敗，繼續等待其他請求
+    """
+    async with genai.Client(api_key=api_key).aio as client:
+        pending = {
+            asyncio.create_task(client.models.generate_content(model=model, contents=contents, config=config))
+            for model, contents, config in requests
+        }
+        last_error = None
+        got_blank = False
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        last_error = task.exception()
+                    elif (task.result().text or "").strip():
+                        return task.result().text
+                    else:
+                        got_blank = True
+            # 所有請求都沒有報告：有空白回覆時回傳空字串 (與串流路徑一致，不寫入快取)
+            if got_blank or last_error is None:
+                return ""
+            raise last_error
+        finally:
+            for task in pending:
+                task.cancel()
+
+def _stream_report(client, model, contents, config_kwargs, service_tier, placeholder):
+    """以串流方式產生報告；從選定的層級開始，額度不足 (429 RESOURCE_EXHAUSTED) 時依 priority → standard → flex 降級"""
+    tiers = SERVICE_TIER_LADDER[SERVICE_TIER_LADDER.index(service_tier):]
+    for tier in tiers:
+        try:
+            stream = client.models.generate_content_stream(
+                model=model,
+                contents=contents,
+                config=types.GenerateContentConfig(service_tier=tier, **GENERATION_PARAMS, **config_kwargs),
+            )
+            parts = []
+            last_render = 0.0
+            for chunk in stream:
+                parts.append(chunk.text or "")
+                # 累積用 list，重繪限制頻率，避免每個 chunk 都串接並重送整份報告
+                if placeholder is not None and time.monotonic() - last_render >= STREAM_RENDER_INTERVAL:
+                    placeholder.markdown("".join(parts))
+                    last_render = time.monotonic()
+            return "".join(parts)
+        except errors.APIError as e:
+            if e.code != 429 or tier == tiers[-1]:
+                raise
+            st.warning(f"{tier} 層級額度不足，改用下一層級重試...")
+
+def analyze_compliance(api_key, ad_copy, reference_data, service_tier="standard", placeholder=None, hedged=False,
+                       prescreen=False, semantic_cache=False):
+    """
+    Gemini 分析邏輯，失敗時顯示錯誤並回傳 None。
+    傳入 placeholder (st.empty()) 時會隨串流即時更新報告；
+    hedged=True 時同時呼叫主模型與備援模型，採用先完成者 (不串流)；
+    prescreen=True 時先做本地關鍵字快篩，明顯安全的短文案不呼叫 Gemini；
+    semantic_cache=True 時相似文案也沿用快取報告 (完全相同的文案一律沿用)
+    """
+    if not api_key:
+        st.error("請先輸入 API Key")
+        return None
+
+    if prescreen:
+        report = prescreen_ad_copy(ad_copy)
+        if report is not None:
+            st.caption("⚡ 關鍵字快篩未發現敏感詞，未呼叫 Gemini")
+            return report
+
+    client = get_client(api_key)
+
+    try:
+        reference_hash = _sha256(reference_data)
+        # 快取依 API Key 分區：索引中保存了原文案，不同使用者不可互相命中或看到彼此未發表的文案
+        context_hash = _sha256(_sha256(api_key), MODEL_NAME, SYSTEM_INSTRUCTION, build_prompt("", ""), reference_hash)
+        report_key = _sha256(context_hash, ad_copy)
+        cached_report = load_cached_report(report_key)
+        if cached_report is not None:
+            st.caption("♻️ 相同文案，沿用快取報告")
+            return cached_report
+        embedding = _embed_ad_copy(client, ad_copy)
+        similar = find_similar_report(context_hash, embedding, ad_copy) if semantic_cache else None
+        if similar is not None:
+            cached_report, original_copy = similar
+            st.caption("♻️ 與先前相似的文案 (敏感詞相同)，沿用快取報告；報告中引用的句子來自下列原文案")
+            with st.expander("查看快取報告對應的原文案"):
+                st.text(original_copy)
+            return cached_report
+
+        cache_name = None
+        retrieved = False
+        if len(reference_data) > RETRIEVAL_MIN_CHARS and embedding is not None:
+            # 資料庫過大：只送出與文案最相關的區塊 (前綴每次不同，因此不使用 Context Cache)
+            try:
+                chunks, vectors = get_reference_index(api_key, reference_hash, reference_data)
+                reference_data = select_relevant_chunks(chunks, vectors, embedding)
+                retrieved = True
+            except Exception as e:
+                st.warning(f"資料庫檢索失敗，改為送出完整資料庫: {e}")
+        else:
+            cache_name = get_reference_cache(api_key, reference_hash, reference_data)
+
+        if cache_name is not None:
+            # 資料庫前綴已在伺服器端快取，只需送出文案部分
+            contents = build_ad_block(ad_copy)
+            config_kwargs = {"cached_content": cache_name}
+        else:
+            if not retrieved:
+                reference_data = fit_reference_to_budget(api_key, reference_hash, reference_data, ad_copy)
+            contents = build_prompt(ad_copy, reference_data)
+            config_kwargs = {"system_instruction": SYSTEM_INSTRUCTION}
+
+        fallback_config_kwargs = {"system_instruction": SYSTEM_INSTRUCTION}
+        if hedged:
+            # 備援模型無法使用主模型建立的 Context Cache，因此送出完整 Prompt
+            text = asyncio.run(_hedged_generate(api_key, [
+                (MODEL_NAME, contents, types.GenerateContentConfig(
+                    service_tier=service_tier, **GENERATION_PARAMS, **config_kwargs)),
+                (FALLBACK_MODEL_NAME, build_prompt(ad_copy, reference_data), types.GenerateContentConfig(
+                    service_tier=service_tier, **GENERATION_PARAMS, **fallback_config_kwargs)),
+            ]))
+        else:
+            try:
+                text = _stream_report(client, MODEL_NAME, contents, config_kwargs, service_tier, placeholder)
+            except errors.APIError as e:
+                # 若主模型無法存取 (例如帳號沒有 preview 權限)，改用備援模型
+                if e.code != 404:
+                    raise
+                st.warning(f"{MODEL_NAME} 無法存取，切換至 {FALLBACK_MODEL_NAME} 進行分析...")
+                text = _stream_report(
+                    client, FALLBACK_MODEL_NAME, build_prompt(ad_copy, reference_data), fallback_config_kwargs,
+                    service_tier, placeholder
+                )
+        # 空白回覆 (例如被安全機制擋下) 不寫入快取，否則之後相同文案都會拿到空報告
+        if text.strip():
+            store_cached_report(context_hash, report_key, embedding, ad_copy, text)
+        return text
+    except Exception as e:
+        st.error(f"分析發生錯誤: {e}")
+        return None
+
+# =========================================================
+# Helper Functions: Gemini Batch API
+# =========================================================
+def submit_batch_analysis(api_key, ad_copies, reference_data):
+    """
+    將多篇文案寫成 JSONL 上傳並建立 Batch 工作，回傳工作名稱 (不等待結果)
+    """
+    client = get_client(api_key)
+    reference_hash = _sha256(reference_data)
+    index = None
+    if len(reference_data) > RETRIEVAL_MIN_CHARS:
+        # 資料庫過大：與單篇分析相同，每篇文案只附上最相關的區塊，避免每一列都重複送出整份資料庫
+        try:
+            index = get_reference_index(api_key, reference_hash, reference_data)
+        except Exception as e:
+            st.warning(f"資料庫檢索失敗，改為送出完整資料庫: {e}")
+    full_reference = None
+
+    with tempfile.NamedTemporaryFile("w", suffix=".jsonl", encoding="utf-8", delete=False) as f:
+        for i, ad_copy in enumerate(ad_copies):
+            embedding = _embed_ad_copy(client, ad_copy) if index is not None else None
+            if embedding is not None:
+                reference = select_relevant_chunks(*index, embedding)
+            else:
+                if full_reference is None:
+                    # 附上完整資料庫時依最長的文案截斷一次，確保每個請求都不超過模型輸入上限
+                    longest_copy = max(ad_copies, key=len)
+                    full_reference = fit_reference_to_budget(api_key, reference_hash, reference_data, longest_copy)
+                reference = full_reference
+            row = {
+                "key": str(i),
+                "request": {
+                    "contents": [{"role": "user", "parts": [{"text": build_prompt(ad_copy, reference)}]}],
+                    "system_instruction": {"parts": [{"text": SYSTEM_INSTRUCTION}]},
+                    "generation_config": GENERATION_PARAMS,
+                },
+            }
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        jsonl_path = f.name
+
+    try:
+        uploaded = client.files.upload(
+            file=jsonl_path,
+            config=types.UploadFileConfig(display_name="compliance-batch", mime_type="jsonl"),
+        )
+    finally:
+        os.remove(jsonl_path)
+
+    batch_job = client.batches.create(
+        model=MODEL_NAME,
+        src=uploaded.name,
+        config={"display_name": "compliance-batch"},
+    )
+    return batch_job.name
+
+def fetch_batch_results(api_key, job_name):
+    """
+    查詢 Batch 工作狀態；完成時回傳 (狀態, 依原順序排列的報告列表)，否則報告為 None
+    """
+    client = get_client(api_key)
+    batch_job = client.batches.get(name=job_name)
+    state = batch_job.state.name
+    if state != "JOB_STATE_SUCCEEDED":
+        return state, None
+
+    content = client.files.download(file=batch_job.dest.file_name).decode("utf-8")
+    reports = {}
+    for line in content.splitlines():
+        if not line.strip(): continue
+        row = json.loads(line)
+        if "response" in row:
+            # 被安全機制擋下的請求只有 promptFeedback，沒有 candidates / content / parts
+            response = row["response"]
+            candidates = response.get("candidates") or [{}]
+            parts = candidates[0].get("content", {}).get("parts", [])
+            text = "".join(p.get("text", "") for p in parts)
+            if not text.strip():
+                reason = response.get("promptFeedback", {}).get("blockReason") or candidates[0].get("finishReason")
+                text = f"AI 無回覆 / 被阻擋: {reason}" if reason else "AI 無回覆"
+            reports[int(row["key"])] = text
+        else:
+            reports[int(row["key"])] = f"AI 分析錯誤: {row.get('error')}"
+    return state, [reports[k] for k in sorted(reports)]
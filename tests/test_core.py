@@ -0,0 +1,313 @@
+import asyncio
+import json
+
+import numpy as np
+import pytest
+
+import core
+
+
+@pytest.fixture
+def report_cache_dir(tmp_path, monkeypatch):
+    cache_dir = tmp_path / "reports"
+    monkeypatch.setattr(core, "REPORT_CACHE_DIR", str(cache_dir))
+    return cache_dir
+
+
+def _unit(*values):
+    vector = np.asarray(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def test_report_cache_round_trip(report_cache_dir):
+    core.store_cached_report("ctx", "key", _unit(1, 0), "好喝的咖啡", "報告")
+
+    assert core.load_cached_report("key") == "報告"
+    assert core.find_similar_report("ctx", _unit(1, 0.01), "好喝的咖啡！") == ("報告", "好喝的咖啡")
+    assert core.find_similar_report("ctx", _unit(0, 1), "好喝的咖啡") is None
+
+
+def test_report_cache_evicts_oldest_reports(report_cache_dir, monkeypatch):
+    monkeypatch.setattr(core, "REPORT_CACHE_MAX_ENTRIES", 2)
+    for i, vector in enumerate([_unit(1, 0), _unit(0, 1), _unit(1, 1)]):
+        core.store_cached_report("ctx", f"key{i}", vector, f"文案{i}", f"報告{i}")
+
+    assert core.load_cached_report("key0") is None
+    assert sorted(p.name for p in report_cache_dir.glob("*.md")) == ["key1.md", "key2.md"]
+    assert core.find_similar_report("ctx", _unit(1, 0), "文案0") is None
+    assert core.find_similar_report("ctx", _unit(0, 1), "文案1") == ("報告1", "文案1")
+
+def test_similar_copy_with_different_sensitive_terms_is_a_miss(report_cache_dir):
+    core.store_cached_report("ctx", "key", _unit(1, 0), "這款益生菌幫助消化", "低風險報告")
+
+    assert core.find_similar_report("ctx", _unit(1, 0), "這款益生菌保證根治消化問題") is None
+    assert not list(report_cache_dir.glob("*.tmp"))
+
+
+def test_unwritable_report_cache_is_ignored(tmp_path, monkeypatch):
+    blocker = tmp_path / "not-a-dir"
+    blocker.write_text("")
+    monkeypatch.setattr(core, "REPORT_CACHE_DIR", str(blocker / "reports"))
+
+    core.store_cached_report("ctx", "key", _unit(1, 0), "文案", "報告")
+
+    assert core.load_cached_report("key") is None
+    assert core.find_similar_report("ctx", _unit(1, 0), "文案") is None
+
+
+def test_corrupt_report_index_is_a_miss_and_rebuilt(report_cache_dir):
+    report_cache_dir.mkdir()
+    (report_cache_dir / "ctx.npz").write_bytes(b"PK\x03\x04 truncated")
+
+    assert core.find_similar_report("ctx", _unit(1, 0), "文案") is None
+
+    core.store_cached_report("ctx", "key", _unit(1, 0), "文案", "報告")
+    assert core.find_similar_report("ctx", _unit(1, 0), "文案") == ("報告", "文案")
+
+
+class _StubModels:
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def embed_content(self, model, contents):
+        raise RuntimeError("embedding unavailable")
+
+    def generate_content_stream(self, model, contents, config):
+        return iter(self.chunks)
+
+
+class _StubClient:
+    def __init__(self, *texts):
+        self.models = _StubModels([type("Chunk", (), {"text": text})() for text in texts])
+
+
+@pytest.fixture
+def stub_gemini(monkeypatch):
+    monkeypatch.setattr(core, "get_reference_cache", lambda *args: None)
+
+    def install(*texts):
+        monkeypatch.setattr(core, "get_client", lambda api_key: _StubClient(*texts))
+
+    return install
+
+
+def test_analysis_survives_report_cache_failure(stub_gemini, tmp_path, monkeypatch):
+    blocker = tmp_path / "not-a-dir"
+    blocker.write_text("")
+    monkeypatch.setattr(core, "REPORT_CACHE_DIR", str(blocker / "reports"))
+    stub_gemini("## 報告")
+
+    assert core.analyze_compliance("key", "文案", "資料庫") == "## 報告"
+
+
+def test_semantic_cache_is_opt_in(stub_gemini, report_cache_dir, monkeypatch):
+    monkeypatch.setattr(core, "_embed_ad_copy", lambda client, ad_copy: _unit(1, 0))
+    stub_gemini("幫助消化的報告")
+    core.analyze_compliance("key", "這款益生菌幫助消化", "資料庫")
+
+    stub_gemini("改善便秘的報告")
+    assert core.analyze_compliance("key", "這款益生菌改善便秘", "資料庫") == "改善便秘的報告"
+    assert core.analyze_compliance("key", "這款益生菌改善排便", "資料庫", semantic_cache=True) == "幫助消化的報告"
+
+def test_report_cache_is_scoped_by_api_key(stub_gemini, report_cache_dir, monkeypatch):
+    monkeypatch.setattr(core, "_embed_ad_copy", lambda client, ad_copy: _unit(1, 0))
+    stub_gemini("甲的報告")
+    core.analyze_compliance("key-a", "未發表的文案", "資料庫")
+
+    stub_gemini("乙的報告")
+    assert core.analyze_compliance("key-b", "未發表的文案", "資料庫") == "乙的報告"
+    assert core.analyze_compliance("key-b", "未發表的文案！", "資料庫", semantic_cache=True) == "乙的報告"
+    assert core.analyze_compliance("key-a", "未發表的文案", "資料庫") == "甲的報告"
+
+class _StubAsyncModels:
+    def __init__(self, texts):
+        self.texts = texts
+
+    async def generate_content(self, model, contents, config):
+        delay, text = self.texts[model]
+        await asyncio.sleep(delay)
+        return type("Response", (), {"text": text})()
+
+
+class _StubAsyncClient:
+    def __init__(self, texts):
+        self.models = _StubAsyncModels(texts)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+def test_hedged_analysis_waits_past_blank_reply(stub_gemini, report_cache_dir, monkeypatch):
+    texts = {core.MODEL_NAME: (0, None), core.FALLBACK_MODEL_NAME: (0.05, "## 備援報告")}
+    monkeypatch.setattr(core.genai, "Client", lambda api_key: type("Client", (), {"aio": _StubAsyncClient(texts)})())
+    stub_gemini()
+
+    assert core.analyze_compliance("key", "文案", "資料庫", hedged=True) == "## 備援報告"
+
+def test_empty_report_is_not_cached(stub_gemini, report_cache_dir):
+    stub_gemini("")
+    assert core.analyze_compliance("key", "文案", "資料庫") == ""
+    assert not report_cache_dir.exists() or not list(report_cache_dir.glob("*.md"))
+
+    stub_gemini("## 報告")
+    assert core.analyze_compliance("key", "文案", "資料庫") == "## 報告"
+
+
+class _StubBatchClient:
+    def __init__(self):
+        self.rows = []
+        self.files = self
+        self.batches = self
+
+    def upload(self, file, config):
+        with open(file, encoding="utf-8") as f:
+            self.rows = [json.loads(line) for line in f]
+        return type("Uploaded", (), {"name": "files/batch"})()
+
+    def create(self, model, src, config):
+        return type("BatchJob", (), {"name": "batches/1"})()
+
+    def get(self, name):
+        state = type("State", (), {"name": "JOB_STATE_SUCCEEDED"})()
+        dest = type("Dest", (), {"file_name": "files/results"})()
+        return type("BatchJob", (), {"state": state, "dest": dest})()
+
+    def download(self, file):
+        return "\n".join(json.dumps(row, ensure_ascii=False) for row in self.rows).encode("utf-8")
+
+
+def test_batch_rows_fit_input_budget(monkeypatch):
+    client = _StubBatchClient()
+    monkeypatch.setattr(core, "get_client", lambda api_key: client)
+    monkeypatch.setattr(core, "count_reference_tokens", lambda api_key, reference_hash, reference_data: len(reference_data) * 2)
+    monkeypatch.setattr(core, "MAX_INPUT_TOKENS", 1000)
+
+    assert core.submit_batch_analysis("key", ["短文案", "長" * 100], "Ω" * 2000) == "batches/1"
+
+    prompts = [row["request"]["contents"][0]["parts"][0]["text"] for row in client.rows]
+    assert len(prompts) == 2
+    assert all(prompt.count("Ω") == 300 for prompt in prompts)
+
+class _StubRetrievalBatchClient(_StubBatchClient):
+    def __init__(self):
+        super().__init__()
+        self.models = self
+
+    def embed_content(self, model, contents):
+        texts = [contents] if isinstance(contents, str) else contents
+        embedding = lambda text: type("Embedding", (), {"values": [1.0, 0.0] if "甲" in text else [0.0, 1.0]})()
+        return type("Result", (), {"embeddings": [embedding(text) for text in texts]})()
+
+
+def test_batch_rows_use_retrieval_for_large_reference(tmp_path, monkeypatch):
+    client = _StubRetrievalBatchClient()
+    monkeypatch.setattr(core, "get_client", lambda api_key: client)
+    monkeypatch.setattr(core, "INDEX_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(core, "CHUNK_SIZE", 4)
+    monkeypatch.setattr(core, "RETRIEVAL_TOP_K", 1)
+    monkeypatch.setattr(core, "RETRIEVAL_MIN_CHARS", 5)
+    core.get_reference_index.clear()
+
+    core.submit_batch_analysis("key", ["甲產品文案", "乙產品文案"], "甲類規定\n\n乙類規定")
+
+    prompts = [row["request"]["contents"][0]["parts"][0]["text"] for row in client.rows]
+    assert "甲類規定" in prompts[0] and "乙類規定" not in prompts[0]
+    assert "乙類規定" in prompts[1] and "甲類規定" not in prompts[1]
+
+def test_blocked_batch_row_does_not_fail_the_fetch(monkeypatch):
+    client = _StubBatchClient()
+    client.rows = [
+        {"key": "0", "response": {"candidates": [{"content": {"parts": [{"text": "## 報告"}]}}]}},
+        {"key": "1", "response": {"promptFeedback": {"blockReason": "SAFETY"}}},
+        {"key": "2", "response": {"candidates": [{"finishReason": "SAFETY"}]}},
+    ]
+    monkeypatch.setattr(core, "get_client", lambda api_key: client)
+
+    state, reports = core.fetch_batch_results("key", "batches/1")
+
+    assert state == "JOB_STATE_SUCCEEDED"
+    assert reports == ["## 報告", "AI 無回覆 / 被阻擋: SAFETY", "AI 無回覆 / 被阻擋: SAFETY"]
+
+def test_budget_fallback_assumes_worst_case_tokens_per_char(monkeypatch):
+    def count_tokens_unavailable(api_key, reference_hash, reference_data):
+        raise RuntimeError("count_tokens unavailable")
+
+    monkeypatch.setattr(core, "count_reference_tokens", count_tokens_unavailable)
+    monkeypatch.setattr(core, "MAX_INPUT_TOKENS", 1000)
+
+    assert core.fit_reference_to_budget("key", "ref", "😀" * 200, "") == "😀" * 200
+    assert core.fit_reference_to_budget("key", "ref", "😀" * 400, "文案" * 50) == "😀" * 150
+
+class _StubEmbedClient:
+    def __init__(self):
+        self.models = self
+
+    def embed_content(self, model, contents):
+        embedding = type("Embedding", (), {"values": [1.0, 0.0]})
+        return type("Result", (), {"embeddings": [embedding() for _ in contents]})()
+
+
+def test_corrupt_reference_index_is_rebuilt(tmp_path, monkeypatch):
+    monkeypatch.setattr(core, "INDEX_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(core, "get_client", lambda api_key: _StubEmbedClient())
+    index_key = core._sha256(core.EMBEDDING_MODEL, "lines", str(core.CHUNK_SIZE), "ref")
+    (tmp_path / f"{index_key}.npz").write_bytes(b"truncated")
+    core.get_reference_index.clear()
+
+    chunks, vectors = core.get_reference_index("key", "ref", "第一條\n第二條")
+
+    assert chunks == ["第一條\n第二條"]
+    assert vectors.shape == (1, 2)
+    with np.load(tmp_path / f"{index_key}.npz") as index:
+        assert index["chunks"].tolist() == chunks
+    assert [p.name for p in tmp_path.iterdir()] == [f"{index_key}.npz"]
+
+def _make_pdf(pages):
+    """以 PDFium 產生每頁含指定文字行的 PDF bytes"""
+    import ctypes
+    import io
+
+    import pypdfium2 as pdfium
+    import pypdfium2.raw as pdfium_c
+
+    pdf = pdfium.PdfDocument.new()
+    for lines in pages:
+        page = pdf.new_page(300, 400)
+        for offset, line in enumerate(lines):
+            obj = pdfium_c.FPDFPageObj_NewTextObj(pdf.raw, b"Helvetica", 12.0)
+            text = ctypes.create_string_buffer((line + "\x00").encode("utf-16-le"))
+            pdfium_c.FPDFText_SetText(obj, ctypes.cast(text, ctypes.POINTER(pdfium_c.FPDF_WCHAR)))
+            pdfium_c.FPDFPageObj_Transform(obj, 1, 0, 0, 1, 20, 380 - 20 * offset)
+            pdfium_c.FPDFPage_InsertObject(page.raw, obj)
+        pdfium_c.FPDFPage_GenerateContent(page.raw)
+        page.close()
+    buffer = io.BytesIO()
+    pdf.save(buffer)
+    pdf.close()
+    return buffer.getvalue()
+
+
+def test_pdf_pages_are_separated_by_blank_lines():
+    data = _make_pdf([["Header", "Case 1 rule"], ["Header", "Case 2 rule"]])
+
+    assert core.read_pdf_bytes(data) == "Header\nCase 1 rule\n\nHeader\nCase 2 rule"
+
+
+def test_dedupe_drops_duplicated_pdf_page():
+    data = _make_pdf([["Header", "Case 1 rule"], ["Header", "Case 2 rule"], ["Header", "Case 1 rule"]])
+
+    assert core.dedupe_paragraphs(core.read_pdf_bytes(data)) == "Header\nCase 1 rule\n\nHeader\nCase 2 rule"
+
+
+def test_chunk_reference_keeps_pdf_lines_whole(monkeypatch):
+    monkeypatch.setattr(core, "CHUNK_SIZE", 30)
+    lines = [f"Case {i} rule text" for i in range(6)]
+    data = _make_pdf([lines[:3], lines[3:]])
+
+    chunks = core.chunk_reference(core.read_pdf_bytes(data))
+
+    assert all(len(chunk) <= 30 for chunk in chunks)
+    assert [line for chunk in chunks for line in chunk.split("\n")] == lines